@@ -0,0 +1,24 @@
+#!/bin/bash
+
+# WhisperX API container entrypoint
+# Starts uvicorn with uvloop/httptools and, optionally, the NVIDIA MPS daemon so
+# several worker processes can share one GPU without context-switch overhead.
+
+set -e
+
+if [ "${ENABLE_MPS:-0}" = "1" ]; then
+    if command -v nvidia-cuda-mps-control &> /dev/null; then
+        echo "Starting NVIDIA MPS control daemon..."
+        nvidia-cuda-mps-control -d
+    else
+        echo "Warning: ENABLE_MPS=1 but nvidia-cuda-mps-control was not found, workers will time-slice the GPU"
+    fi
+fi
+
+# Each worker is a separate process with its own copy of the models
+exec uvicorn main:app \
+    --host 0.0.0.0 \
+    --port 8000 \
+    --workers "${UVICORN_WORKERS:-1}" \
+    --loop uvloop \
+    --http httptools
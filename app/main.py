@@ -17,15 +17,38 @@ import os
 
 # # Now import libraries that depend on cuDNN
 
+# Let the CUDA caching allocator grow segments instead of fragmenting, so models can
+# stay resident without emptying the cache on every request. Must be set before torch loads.
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:512")
+
 from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 import whisperx
+from whisperx.audio import SAMPLE_RATE, N_SAMPLES, N_FFT, HOP_LENGTH, mel_filters
+from whisperx.diarize import DiarizationPipeline
 import torch
 import gc
+import asyncio
+import tempfile
+import contextlib
+import subprocess
+from uuid import uuid4
+from collections import OrderedDict
 from typing import Optional
+import numpy as np
+import orjson
 import nltk
 
+# Inference only: no autograd bookkeeping, and TF32 for any float32 matmuls/convolutions.
+# cuDNN autotuning is opt-in because alignment sees a new input length on almost every
+# segment, and benchmark mode re-tunes for each new shape.
+torch.set_grad_enabled(False)
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.benchmark = os.getenv("CUDNN_BENCHMARK", "0") == "1"
+
 # Download required NLTK data at startup
 print("Downloading NLTK data...")
 try:
@@ -34,23 +57,495 @@ try:
 except Exception as e:
     print(f"Warning: Could not download NLTK data: {e}")
 
+class _ORJSONResponse(JSONResponse):
+    """JSON response encoded with orjson, which also accepts NumPy arrays and scalars"""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Load one replica per visible GPU when the server starts
+
+    Loading here rather than at import keeps a uvicorn supervisor process (or a
+    second import of this module) from holding its own unused copy of the models.
+    """
+    if DEVICE == "cuda":
+        WORKERS.extend(_Worker("cuda", i) for i in range(torch.cuda.device_count()))
+    else:
+        WORKERS.append(_Worker(DEVICE))
+    for worker in WORKERS:
+        _idle_workers.put_nowait(worker)
+    yield
+
+
 app = FastAPI(
     title="WhisperX API",
     description="WhisperX API with Transcription, Alignment, and Diarization",
-    version="1.0.0"
+    version="1.0.0",
+    # orjson serializes large segment/word lists much faster than the stdlib encoder
+    default_response_class=_ORJSONResponse,
+    lifespan=lifespan
 )
 
 # Configuration
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 COMPUTE_TYPE = "float16" if DEVICE == "cuda" else "int8"
 BATCH_SIZE = 16
+BATCH_GAP_SECONDS = 30  # Silence between files in a batch; matches WhisperX's VAD chunk size
+STREAM_WINDOW_SECONDS = int(os.getenv("STREAM_WINDOW_SECONDS", "60"))  # Audio per window when streaming
+PINNED_UPLOAD_MAX_SECONDS = int(os.getenv("PINNED_UPLOAD_MAX_SECONDS", "1800"))  # Longer audio is aligned from host memory
+BATCH_MAX_SECONDS = int(os.getenv("BATCH_MAX_SECONDS", "3600"))  # Audio per batched transcribe call
 MODEL_NAME = os.getenv("WHISPER_MODEL", "large-v3")
 HF_TOKEN = os.getenv("HF_TOKEN")  # Required for diarization
+# Uploads are written to tmpfs when available so the decode never touches disk
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir())
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+DIARIZE_LAZY = os.getenv("DIARIZE_LAZY", "0") == "1"  # Defer diarization model load to first request
+DIARIZE_EMBEDDING_BATCH_SIZE = int(os.getenv("DIARIZE_EMBEDDING_BATCH_SIZE", "32"))
+DIARIZE_FP16 = os.getenv("DIARIZE_FP16", "0") == "1"  # Run the speaker-embedding ResNet in float16 on CUDA
+ALIGN_CACHE_SIZE = int(os.getenv("ALIGN_CACHE_SIZE", "3"))  # Alignment models kept resident
+WARMUP = os.getenv("WARMUP", "1") == "1"  # Run a dummy inference at startup
+
+class _MelFrontend(torch.nn.Module):
+    """Whisper log-mel front end, mirroring whisperx.audio.log_mel_spectrogram"""
+
+    def __init__(self, n_mels: int, device: str):
+        super().__init__()
+        # Constant window and filterbank are built once and stay resident on the device
+        self.register_buffer("window", torch.hann_window(N_FFT, device=device))
+        self.register_buffer("filters", mel_filters(torch.device(device), n_mels))
+
+    def forward(self, audio: np.ndarray, padding: int = 0) -> torch.Tensor:
+        waveform = torch.from_numpy(audio).to(self.window.device, non_blocking=True)
+        if padding > 0:
+            waveform = torch.nn.functional.pad(waveform, (0, padding))
+        stft = torch.stft(waveform, N_FFT, HOP_LENGTH, window=self.window, return_complex=True)
+        magnitudes = stft[..., :-1].abs() ** 2
+        mel_spec = self.filters @ magnitudes
+        log_spec = torch.clamp(mel_spec, min=1e-10).log10()
+        log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
+        return (log_spec + 4.0) / 4.0
+
+
+def _autocast_forward(module: torch.nn.Module):
+    """Run a module's forward under float16 autocast and hand float32 tensors back"""
+    forward = module.forward
+
+    def autocast_forward(*args, **kwargs):
+        with torch.autocast("cuda", dtype=torch.float16):
+            outputs = forward(*args, **kwargs)
+        if isinstance(outputs, tuple):
+            return tuple(o.float() if torch.is_tensor(o) else o for o in outputs)
+        return outputs.float()
+
+    module.forward = autocast_forward
+
+
+def _load_diarize_model(device: str):
+    """Build the diarization pipeline with batched speaker-embedding inference"""
+    print(f"Loading diarization pipeline on device: {device}")
+    diarize_model = DiarizationPipeline(use_auth_token=HF_TOKEN, device=device)
+    # Embedding extraction dominates pyannote's runtime; batch the sliding windows
+    diarize_model.model.embedding_batch_size = DIARIZE_EMBEDDING_BATCH_SIZE
+    # Only the ResNet trunk may run in float16: the fbank front end works on an
+    # int16-scaled power spectrum whose values overflow float16 and turn into NaN
+    if DIARIZE_FP16 and device.startswith("cuda"):
+        try:
+            _autocast_forward(diarize_model.model._embedding.model_.resnet)
+        except AttributeError:
+            print("Warning: DIARIZE_FP16 needs a WeSpeaker ResNet embedding, running in float32")
+    print("Diarization pipeline loaded successfully!")
+    return diarize_model
+
+
+def _speaking_time(times: np.ndarray, turn_starts: np.ndarray, turn_ends: np.ndarray) -> np.ndarray:
+    """Time one speaker has spoken before each of the given times"""
+    order = np.argsort(turn_starts, kind="stable")
+    turn_starts, turn_ends = turn_starts[order], turn_ends[order]
+    # Flatten overlapping turns into sorted, disjoint intervals with the same union
+    covered_until = np.maximum.accumulate(turn_ends)
+    turn_starts = np.maximum(turn_starts, np.concatenate(([-np.inf], covered_until[:-1])))
+    durations = np.maximum(covered_until - turn_starts, 0.0)
+    spoken_before = np.concatenate(([0.0], np.cumsum(durations)))
+
+    # Everything before the last turn that starts at or before t, plus the part of that turn
+    k = np.searchsorted(turn_starts, times, side="right")
+    last = np.maximum(k - 1, 0)
+    partial = np.clip(times - turn_starts[last], 0.0, durations[last])
+    return np.where(k > 0, spoken_before[last] + partial, 0.0)
+
+
+def _assign_word_speakers(diarize_segments, result: dict) -> dict:
+    """
+    Assign the speaker with the most overlap to each segment and word
+
+    Like whisperx.assign_word_speakers, but computed on flat NumPy arrays: each
+    interval's overlap with a speaker is the difference of that speaker's
+    cumulative speaking time at its end and start, found with np.searchsorted,
+    instead of a scan over every diarization turn per word. Overlapping turns of
+    the same speaker count once (their union), not once per turn. Ties go to the
+    lowest speaker label.
+    """
+    items = []
+    for seg in result.get("segments", []):
+        if "start" in seg:
+            items.append(seg)
+        items.extend(word for word in seg.get("words", []) if "start" in word)
+    if not items or len(diarize_segments) == 0:
+        return result
+
+    starts = np.fromiter((item["start"] for item in items), dtype=np.float64, count=len(items))
+    ends = np.fromiter((item["end"] for item in items), dtype=np.float64, count=len(items))
+    speakers, speaker_ids = np.unique(diarize_segments["speaker"].to_numpy(), return_inverse=True)
+    turn_starts = diarize_segments["start"].to_numpy(dtype=np.float64)
+    turn_ends = diarize_segments["end"].to_numpy(dtype=np.float64)
+
+    overlaps = np.empty((len(items), len(speakers)))
+    for s in range(len(speakers)):
+        mask = speaker_ids == s
+        overlaps[:, s] = (
+            _speaking_time(ends, turn_starts[mask], turn_ends[mask])
+            - _speaking_time(starts, turn_starts[mask], turn_ends[mask])
+        )
+
+    # Cumulative sums leave ~1e-15 noise on exact ties; round so argmax picks the first label
+    overlaps = np.round(overlaps, 6)
+    best = overlaps.argmax(axis=1)
+    found = overlaps[np.arange(len(items)), best] > 0
+    for item, speaker, has_speaker in zip(items, speakers[best].tolist(), found.tolist()):
+        if has_speaker:
+            item["speaker"] = speaker
+    return result
+
+
+class _Worker:
+    """
+    Model replicas and per-device state for one GPU (or the CPU)
+
+    A worker serves one request at a time (see _acquire_worker), so its
+    alignment cache and CUDA streams need no locking.
+    """
+
+    def __init__(self, device: str, device_index: int = 0):
+        self.is_cuda = device == "cuda"
+        self.device = f"cuda:{device_index}" if self.is_cuda else device
+        self.device_index = device_index
+
+        with self.context():
+            print(f"Loading WhisperX model '{MODEL_NAME}' on device: {self.device}")
+            self.model = whisperx.load_model(
+                MODEL_NAME,
+                device,
+                device_index=device_index,
+                compute_type=COMPUTE_TYPE
+            )
+            print("Model loaded successfully!")
+
+            self.mel_frontend = None
+            # Side stream for host-to-device audio copies, overlapped with transcription
+            self.copy_stream = None
+            if self.is_cuda:
+                self.mel_frontend = _MelFrontend(
+                    self.model.model.feat_kwargs.get("feature_size") or 80,
+                    self.device
+                )
+                self.model.preprocess = self._preprocess_on_gpu
+                self.copy_stream = torch.cuda.Stream()
+
+            # Load the diarization pipeline once and keep it resident across requests
+            self.diarize_model = None
+            if HF_TOKEN and not DIARIZE_LAZY:
+                try:
+                    self.diarize_model = _load_diarize_model(self.device)
+                except Exception as e:
+                    # e.g. the token has not accepted the gated pyannote model terms;
+                    # keep serving and let diarize requests retry and report the error
+                    print(f"Warning: Could not load diarization pipeline: {e}")
+
+            # Alignment models are cached per language code and evicted least-recently-used
+            self.align_cache: "OrderedDict[str, tuple]" = OrderedDict()
+
+            if WARMUP:
+                self.warmup()
+
+    def context(self):
+        """Make this worker's GPU the current CUDA device"""
+        if not self.is_cuda:
+            return contextlib.nullcontext()
+        return torch.cuda.device(self.device_index)
+
+    def _preprocess_on_gpu(self, inputs, **kwargs):
+        """Replacement for the pipeline's CPU feature extraction step"""
+        audio = inputs["inputs"]
+        # The pipeline collates these per batch and moves the batch back to the host
+        # for CTranslate2, so there is one device-to-host copy per batch, not per chunk
+        return {"inputs": self.mel_frontend(audio, padding=N_SAMPLES - audio.shape[0])}
+
+    def warmup(self):
+        """
+        Warm up on 30s of silence so CUDA context setup, cuFFT plans and the
+        encoder's kernel selection happen before the first request instead of during it
+        """
+        print(f"Warming up model on device: {self.device}")
+        warmup_audio = np.zeros(N_SAMPLES, dtype=np.float32)
+        self.model.detect_language(warmup_audio)
+        if self.mel_frontend is not None:
+            self.mel_frontend(warmup_audio)
+            torch.cuda.synchronize()
+        print("Warm-up completed!")
+
+    def get_align_model(self, language_code: str):
+        """Return a cached (model, metadata) pair for a language, loading it on first use"""
+        if language_code in self.align_cache:
+            self.align_cache.move_to_end(language_code)
+            return self.align_cache[language_code]
+
+        print(f"Loading alignment model for language: {language_code}")
+        model_a, metadata = whisperx.load_align_model(
+            language_code=language_code,
+            device=self.device
+        )
+        # Alignment only needs the argmax path through the CTC emissions, so reduced
+        # precision is safe: float16 weights on GPU, dynamic int8 linear layers on CPU
+        if self.is_cuda:
+            model_a = model_a.half()
+        else:
+            model_a = torch.ao.quantization.quantize_dynamic(model_a, {torch.nn.Linear}, dtype=torch.qint8)
+        self.align_cache[language_code] = (model_a, metadata)
+
+        # Only release GPU memory when an older language is evicted
+        while len(self.align_cache) > max(ALIGN_CACHE_SIZE, 1):
+            evicted_language, evicted = self.align_cache.popitem(last=False)
+            print(f"Evicting alignment model for language: {evicted_language}")
+            del evicted
+            gc.collect()
+            torch.cuda.empty_cache() if self.is_cuda else None
+
+        return self.align_cache[language_code]
+
+    def get_diarize_model(self):
+        """Return the resident diarization pipeline, loading it on first use when lazy"""
+        if self.diarize_model is None:
+            self.diarize_model = _load_diarize_model(self.device)
+        return self.diarize_model
+
+    def diarize(self, audio: np.ndarray):
+        """Run speaker diarization without autograd"""
+        diarize_model = self.get_diarize_model()
+        with torch.inference_mode():
+            return diarize_model(audio)
+
+    def upload_audio(self, audio: np.ndarray):
+        """
+        Start copying a waveform to the device on a side stream for alignment
+
+        Called before the work the copy should overlap. Returns None on CPU and for
+        audio longer than PINNED_UPLOAD_MAX_SECONDS; alignment then uses the NumPy
+        waveform and uploads one segment at a time, so long files hold neither
+        pinned host memory (never returned to the OS by PyTorch's caching host
+        allocator) nor a full copy in VRAM.
+        """
+        if not self.is_cuda or audio.shape[0] > PINNED_UPLOAD_MAX_SECONDS * SAMPLE_RATE:
+            return None
+        host_audio = torch.from_numpy(audio).pin_memory()
+        with torch.cuda.stream(self.copy_stream):
+            return host_audio.to(self.device, non_blocking=True)
+
+    def wait_for_upload(self, audio_tensor):
+        """Order the compute stream after the side-stream copy before the tensor is used"""
+        if self.is_cuda:
+            compute_stream = torch.cuda.current_stream()
+            compute_stream.wait_stream(self.copy_stream)
+            audio_tensor.record_stream(compute_stream)
+        return audio_tensor
+
+    def transcribe_many(self, audios: list, language: Optional[str] = None) -> list:
+        """
+        Transcribe several waveforms with batched WhisperX calls
+
+        Files are grouped by language and sorted by duration, then packed into
+        buckets of similar-length files holding at most BATCH_MAX_SECONDS of audio.
+        Each bucket is transcribed with a single call.
+        """
+        languages = [language or self.model.detect_language(audio) for audio in audios]
+        results = [{"segments": [], "language": lang} for lang in languages]
+        max_samples = BATCH_MAX_SECONDS * SAMPLE_RATE
+
+        for batch_language in dict.fromkeys(languages):
+            indices = sorted(
+                (i for i, lang in enumerate(languages) if lang == batch_language),
+                key=lambda i: audios[i].shape[0]
+            )
+
+            bucket, bucket_samples = [], 0
+            for i in indices:
+                if bucket and bucket_samples + audios[i].shape[0] > max_samples:
+                    self._transcribe_bucket(bucket, audios, batch_language, results)
+                    bucket, bucket_samples = [], 0
+                bucket.append(i)
+                bucket_samples += audios[i].shape[0]
+            self._transcribe_bucket(bucket, audios, batch_language, results)
+
+        return results
+
+    def _transcribe_bucket(self, indices: list, audios: list, language: str, results: list):
+        """
+        Transcribe a bucket of files in one call, appending segments to results
+
+        Files are concatenated with BATCH_GAP_SECONDS of silence between them, so
+        no VAD chunk can span two files. Segments are then mapped back to their
+        file by cumulative offset.
+        """
+        gap = np.zeros(BATCH_GAP_SECONDS * SAMPLE_RATE, dtype=np.float32)
+        pieces, offsets, position = [], [], 0
+        for i in indices:
+            offsets.append(position / SAMPLE_RATE)
+            pieces += [audios[i], gap]
+            position += audios[i].shape[0] + gap.shape[0]
+
+        with torch.inference_mode():
+            combined = self.model.transcribe(
+                np.concatenate(pieces),
+                batch_size=BATCH_SIZE,
+                language=language
+            )
+
+        for segment in combined["segments"]:
+            k = max(int(np.searchsorted(offsets, segment["start"], side="right")) - 1, 0)
+            offset = offsets[k]
+            results[indices[k]]["segments"].append({
+                **segment,
+                "start": round(segment["start"] - offset, 3),
+                "end": round(segment["end"] - offset, 3)
+            })
+
+    def build_response(self, result: dict, audio, align: bool, diarize: bool, audio_tensor=None) -> dict:
+        """
+        Turn a transcription result into a response, adding alignment and speakers
+
+        audio_tensor is the waveform already uploaded by upload_audio; alignment
+        uses it directly so the audio is not copied to the device again.
+        """
+        detected_language = result.get("language", "unknown")
+        print(f"Detected language: {detected_language}")
+        
+        # Construct full text from segments if not present
+        full_text = result.get("text") or " ".join(
+            seg["text"].strip() for seg in result.get("segments", []) if "text" in seg
+        )
+        
+        # Prepare response
+        response_data = {
+            "text": full_text,
+            "segments": result.get("segments", []),
+            "language": detected_language
+        }
+        result_aligned = result
+        
+        # 2. Align whisper output (word-level timestamps)
+        if align:
+            print("Step 2: Aligning transcription...")
+            try:
+                model_a, metadata = self.get_align_model(detected_language)
+                # Autocast feeds float32 audio to the float16 model and keeps
+                # normalization and log-softmax in float32
+                with torch.inference_mode(), torch.autocast("cuda", dtype=torch.float16, enabled=self.is_cuda):
+                    result_aligned = whisperx.align(
+                        result["segments"],
+                        model_a,
+                        metadata,
+                        self.wait_for_upload(audio_tensor) if audio_tensor is not None else audio,
+                        self.device,
+                        return_char_alignments=False
+                    )
+                
+                response_data["word_segments"] = result_aligned.get("word_segments", [])
+                response_data["segments"] = result_aligned.get("segments", result["segments"])
+                
+                print("Alignment completed!")
+            except Exception as e:
+                print(f"Alignment warning: {str(e)}")
+                response_data["word_segments"] = []
+        
+        # 3. Diarization (speaker identification)
+        if diarize:
+            print("Step 3: Running diarization...")
+            try:
+                diarize_segments = self.diarize(audio)
+                
+                # Assign speakers to segments
+                result_diarized = _assign_word_speakers(
+                    diarize_segments,
+                    result_aligned
+                )
+                
+                response_data["diarization"] = result_diarized.get("segments", [])
+                response_data["segments"] = result_diarized.get("segments", response_data["segments"])
+                
+                print("Diarization completed!")
+            except Exception as e:
+                print(f"Diarization error: {str(e)}")
+                raise HTTPException(
+                    status_code=500,
+                    detail=f"Diarization failed: {str(e)}"
+                )
+        
+        return response_data
+
+    def process(self, audio: np.ndarray, align: bool, diarize: bool, language: Optional[str]) -> dict:
+        """Transcribe, align and diarize one waveform on this worker's device"""
+        with self.context():
+            # Overlap the upload with the encoder
+            audio_tensor = self.upload_audio(audio) if align else None
+            
+            # 1. Transcribe with WhisperX
+            print(f"Step 1: Transcribing audio on {self.device}...")
+            with torch.inference_mode():
+                result = self.model.transcribe(
+                    audio,
+                    batch_size=BATCH_SIZE,
+                    language=language
+                )
+            
+            return self.build_response(result, audio, align, diarize, audio_tensor)
+
+    def process_many(self, audios: list, align: bool, diarize: bool, language: Optional[str]) -> list:
+        """Transcribe several waveforms in one batch, returning a response or exception per file"""
+        with self.context():
+            print(f"Step 1: Transcribing {len(audios)} files in one batch on {self.device}...")
+            try:
+                transcriptions = self.transcribe_many(audios, language)
+            except Exception as e:
+                print(f"Batch transcription error: {str(e)}")
+                return [e] * len(audios)
+            
+            responses = []
+            for result, audio in zip(transcriptions, audios):
+                try:
+                    # Upload one file at a time so VRAM does not grow with the batch size
+                    audio_tensor = self.upload_audio(audio) if align else None
+                    responses.append(self.build_response(result, audio, align, diarize, audio_tensor))
+                except Exception as e:
+                    responses.append(e)
+            return responses
+
 
-# Load WhisperX model once at startup
-print(f"Loading WhisperX model '{MODEL_NAME}' on device: {DEVICE}")
-model = whisperx.load_model(MODEL_NAME, DEVICE, compute_type=COMPUTE_TYPE)
-print("Model loaded successfully!")
+# One worker per visible GPU, filled in by lifespan(); requests go to whichever is idle
+WORKERS: list = []
+_idle_workers: asyncio.Queue = asyncio.Queue()
+
+
+@contextlib.asynccontextmanager
+async def _acquire_worker():
+    """Wait for an idle worker and hold it for the duration of a request"""
+    worker = await _idle_workers.get()
+    try:
+        yield worker
+    finally:
+        _idle_workers.put_nowait(worker)
 
 
 class TranscriptionResponse(BaseModel):
@@ -81,17 +576,152 @@ async def health():
         "status": "healthy",
         "cuda_available": torch.cuda.is_available(),
         "device": DEVICE,
-        "model_loaded": model is not None,
-        "diarization_available": HF_TOKEN is not None
+        "model_loaded": len(WORKERS) > 0,
+        "devices": [worker.device for worker in WORKERS],
+        "diarization_available": HF_TOKEN is not None,
+        "diarization_loaded": bool(WORKERS) and all(worker.diarize_model is not None for worker in WORKERS)
     }
 
 
+def _pcm_to_waveform(pcm: bytes) -> np.ndarray:
+    """Turn raw f32le output from ffmpeg into a float32 waveform"""
+    # Copy into a writable array so torch.from_numpy can share it without warnings
+    return np.frombuffer(pcm, np.float32).copy()
+
+
+def _decode_audio(path: str) -> np.ndarray:
+    """Decode an audio file once with ffmpeg to a 16kHz mono float32 waveform"""
+    cmd = [
+        "ffmpeg", "-nostdin", "-threads", "0", "-i", path,
+        "-f", "f32le", "-ac", "1", "-ar", str(SAMPLE_RATE), "-"
+    ]
+    try:
+        out = subprocess.run(cmd, capture_output=True, check=True).stdout
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"Failed to load audio: {e.stderr.decode()}") from e
+    return _pcm_to_waveform(out)
+
+
+async def _decode_upload(file: UploadFile) -> np.ndarray:
+    """Pipe an upload through ffmpeg in chunks and return a 16kHz mono float32 waveform"""
+    proc = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-nostdin", "-threads", "0", "-i", "pipe:0",
+        "-f", "f32le", "-ac", "1", "-ar", str(SAMPLE_RATE), "pipe:1",
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+
+    async def feed():
+        try:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                proc.stdin.write(chunk)
+                await proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # ffmpeg stopped reading; its exit code reports why
+        finally:
+            proc.stdin.close()
+
+    # Feed stdin while draining stdout/stderr so neither pipe can fill up and block
+    _, out, err = await asyncio.gather(feed(), proc.stdout.read(), proc.stderr.read())
+    if await proc.wait() != 0:
+        raise RuntimeError(f"Failed to load audio: {err.decode()}")
+    return _pcm_to_waveform(out)
+
+
+async def _load_upload(file: UploadFile):
+    """Decode an upload to a 16kHz mono waveform without writing it to disk"""
+    try:
+        return await _decode_upload(file)
+    except RuntimeError as e:
+        # Containers with their index at the end (e.g. some MP4/M4A) need a seekable input
+        print(f"Decoding from pipe failed, retrying from a temporary file: {e}")
+        await file.seek(0)
+        return await _load_upload_from_file(file)
+
+
+async def _load_upload_from_file(file: UploadFile):
+    """Stream an upload to a temporary file in chunks and decode it to a 16kHz mono waveform"""
+    audio_path = os.path.join(UPLOAD_DIR, f"{uuid4().hex}_{os.path.basename(file.filename)}")
+    try:
+        with open(audio_path, "wb") as f:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                f.write(chunk)
+        return await run_in_threadpool(_decode_audio, audio_path)
+    finally:
+        # Cleanup temporary file
+        if os.path.exists(audio_path):
+            try:
+                os.remove(audio_path)
+                print(f"Cleaned up temporary file: {audio_path}")
+            except Exception as e:
+                print(f"Warning: Could not remove temporary file: {e}")
+
+
+def _stream_windows(audio: np.ndarray):
+    """
+    Split a waveform into windows of about STREAM_WINDOW_SECONDS
+
+    Each cut is moved to the quietest 20ms frame in the last two seconds of its
+    window, so words are rarely split between windows.
+    """
+    window = max(STREAM_WINDOW_SECONDS, 2) * SAMPLE_RATE
+    search = 2 * SAMPLE_RATE
+    frame = SAMPLE_RATE // 50
+    start = 0
+    while start + window < audio.shape[0]:
+        region = audio[start + window - search:start + window]
+        energy = np.square(region).reshape(-1, frame).mean(axis=1)
+        end = start + window - search + int(energy.argmin()) * frame + frame // 2
+        yield start, end
+        start = end
+    yield start, audio.shape[0]
+
+
+def _shift_segment(segment: dict, offset: float) -> dict:
+    """Move a segment and its words from window time to file time"""
+    shifted = {**segment, "start": round(segment["start"] + offset, 3), "end": round(segment["end"] + offset, 3)}
+    if "words" in segment:
+        shifted["words"] = [
+            {**word, "start": round(word["start"] + offset, 3), "end": round(word["end"] + offset, 3)}
+            if "start" in word else word
+            for word in segment["words"]
+        ]
+    return shifted
+
+
+async def _stream_segments(audio: np.ndarray, align: bool, language: Optional[str]):
+    """
+    Transcribe a waveform window by window, yielding NDJSON lines
+
+    One line per segment as soon as its window is done, then a final line with
+    the full text and language. Errors after the stream has started are
+    reported as a final {"error": ...} line.
+    """
+    texts = []
+    try:
+        async with _acquire_worker() as worker:
+            for start, end in _stream_windows(audio):
+                response_data = await run_in_threadpool(worker.process, audio[start:end], align, False, language)
+                # Keep the first detected language for later windows, once there was speech
+                if response_data["segments"]:
+                    language = language or response_data["language"]
+                for segment in response_data["segments"]:
+                    texts.append(segment.get("text", "").strip())
+                    yield orjson.dumps(_shift_segment(segment, start / SAMPLE_RATE), option=orjson.OPT_SERIALIZE_NUMPY) + b"\n"
+        yield orjson.dumps({"text": " ".join(texts), "language": language}) + b"\n"
+    except Exception as e:
+        print(f"Streaming error: {str(e)}")
+        yield orjson.dumps({"error": f"Processing failed: {str(e)}"}) + b"\n"
+
+
 @app.post("/transcribe/", response_model=TranscriptionResponse)
 async def transcribe(
     file: UploadFile = File(...),
     align: bool = True,
     diarize: bool = False,
-    language: Optional[str] = None
+    language: Optional[str] = None,
+    stream: bool = False
 ):
     """
     Transcribe audio file with optional alignment and diarization
@@ -101,6 +731,7 @@ async def transcribe(
     - align: Enable word-level alignment (default: True)
     - diarize: Enable speaker diarization (default: False, requires HF_TOKEN)
     - language: Force specific language (optional, auto-detect if not provided)
+    - stream: Return segments as NDJSON while transcription runs (default: False, no diarization)
     """
     
     # Validate file
@@ -114,118 +745,34 @@ async def transcribe(
             detail="Diarization requires HF_TOKEN environment variable to be set"
         )
     
-    audio_path = None
+    # Speaker labels need the whole recording, so they cannot be streamed
+    if stream and diarize:
+        raise HTTPException(
+            status_code=400,
+            detail="Streaming does not support diarization"
+        )
     
     try:
-        # Save uploaded file temporarily
-        audio_path = f"/tmp/{file.filename}"
-        with open(audio_path, "wb") as f:
-            f.write(await file.read())
+        audio = await _load_upload(file)
         
         print(f"Processing file: {file.filename}")
         
-        # 1. Transcribe with WhisperX
-        print("Step 1: Transcribing audio...")
-        audio = whisperx.load_audio(audio_path)
-        result = model.transcribe(
-            audio,
-            batch_size=BATCH_SIZE,
-            language=language
-        )
-        
-        detected_language = result.get("language", "unknown")
-        print(f"Detected language: {detected_language}")
+        if stream:
+            return StreamingResponse(
+                _stream_segments(audio, align, language),
+                media_type="application/x-ndjson"
+            )
         
-        # Construct full text from segments if not present
-        full_text = result.get("text", "")
-        if not full_text and "segments" in result:
-            full_text = " ".join([seg.get("text", "").strip() for seg in result["segments"]])
-        
-        # Prepare response
-        response_data = {
-            "text": full_text,
-            "segments": result.get("segments", []),
-            "language": detected_language
-        }
-        
-        # 2. Align whisper output (word-level timestamps)
-        if align:
-            print("Step 2: Aligning transcription...")
-            try:
-                model_a, metadata = whisperx.load_align_model(
-                    language_code=detected_language,
-                    device=DEVICE
-                )
-                result_aligned = whisperx.align(
-                    result["segments"],
-                    model_a,
-                    metadata,
-                    audio,
-                    DEVICE,
-                    return_char_alignments=False
-                )
-                
-                response_data["word_segments"] = result_aligned.get("word_segments", [])
-                response_data["segments"] = result_aligned.get("segments", result["segments"])
-                
-                # Clear alignment model from memory
-                del model_a
-                gc.collect()
-                torch.cuda.empty_cache() if DEVICE == "cuda" else None
-                
-                print("Alignment completed!")
-            except Exception as e:
-                print(f"Alignment warning: {str(e)}")
-                response_data["word_segments"] = []
-        
-        # 3. Diarization (speaker identification)
-        if diarize:
-            print("Step 3: Running diarization...")
-            try:
-                diarize_model = whisperx.DiarizationPipeline(
-                    use_auth_token=HF_TOKEN,
-                    device=DEVICE
-                )
-                
-                diarize_segments = diarize_model(audio)
-                
-                # Assign speakers to segments
-                result_diarized = whisperx.assign_word_speakers(
-                    diarize_segments,
-                    result_aligned if align else result
-                )
-                
-                response_data["diarization"] = result_diarized.get("segments", [])
-                response_data["segments"] = result_diarized.get("segments", response_data["segments"])
-                
-                # Clear diarization model from memory
-                del diarize_model
-                gc.collect()
-                torch.cuda.empty_cache() if DEVICE == "cuda" else None
-                
-                print("Diarization completed!")
-            except Exception as e:
-                print(f"Diarization error: {str(e)}")
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Diarization failed: {str(e)}"
-                )
+        # Run the blocking GPU work in a thread so other requests can use other devices
+        async with _acquire_worker() as worker:
+            response_data = await run_in_threadpool(worker.process, audio, align, diarize, language)
         
         print(f"Successfully processed: {file.filename}")
-        return JSONResponse(content=response_data)
+        return _ORJSONResponse(content=response_data)
     
     except Exception as e:
         print(f"Error processing file: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Processing failed: {str(e)}")
-    
-    finally:
-        # Cleanup temporary file
-        if audio_path and os.path.exists(audio_path):
-            try:
-                os.remove(audio_path)
-                print(f"Cleaned up temporary file: {audio_path}")
-            except Exception as e:
-                print(f"Warning: Could not remove temporary file: {e}")
 
 
 @app.post("/transcribe/batch/")
@@ -237,28 +784,63 @@ async def transcribe_batch(
 ):
     """
     Transcribe multiple audio files at once
+
+    All successfully decoded files are transcribed together so WhisperX can
+    fill its batches with chunks from several files.
     """
-    results = []
+    # Check diarization requirements
+    if diarize and not HF_TOKEN:
+        raise HTTPException(
+            status_code=400,
+            detail="Diarization requires HF_TOKEN environment variable to be set"
+        )
     
-    for file in files:
+    results = [None] * len(files)
+    audios = {}
+    
+    for i, file in enumerate(files):
         try:
-            result = await transcribe(file, align, diarize, language)
-            results.append({
-                "filename": file.filename,
-                "status": "success",
-                "result": result
-            })
+            audios[i] = await _load_upload(file)
         except Exception as e:
-            results.append({
+            results[i] = {
                 "filename": file.filename,
                 "status": "error",
                 "error": str(e)
-            })
+            }
     
-    return {"results": results}
-
+    if audios:
+        async with _acquire_worker() as worker:
+            responses = await run_in_threadpool(
+                worker.process_many, list(audios.values()), align, diarize, language
+            )
+        
+        for i, response in zip(audios, responses):
+            if isinstance(response, Exception):
+                results[i] = {
+                    "filename": files[i].filename,
+                    "status": "error",
+                    "error": str(response)
+                }
+            else:
+                results[i] = {
+                    "filename": files[i].filename,
+                    "status": "success",
+                    "result": response
+                }
+    
+    return _ORJSONResponse(content={"results": results})
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Multiple workers need an import string; each worker loads its own models
+    # in lifespan(). A single worker reuses this module instead of importing it again.
+    workers = int(os.getenv("UVICORN_WORKERS", "1"))
+    uvicorn.run(
+        app if workers == 1 else "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=workers,
+        loop="uvloop",
+        http="httptools"
+    )
 
@@ -72,6 +72,7 @@ docker run -d \
     --name whisperx-api \
     $GPU_FLAG \
     -p 8000:8000 \
+    --shm-size=2g \
     -e HF_TOKEN="$HF_TOKEN" \
     -e WHISPER_MODEL="$WHISPER_MODEL" \
     -v whisperx-models:/root/.cache \